@@ -1,27 +1,33 @@
+import os
+
+# TensorFlow runtime settings, read once at import: quiet logs, oneDNN kernels, CPU only unless overridden
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+os.environ.setdefault("TF_ENABLE_ONEDNN_OPTS", "1")
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
 import streamlit as st
 import tensorflow as tf
 from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing import image
 import numpy as np
 import plotly.graph_objects as go
 import cv2
 from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Dropout, Flatten
-from tensorflow.keras.optimizers import Adamax
-from tensorflow.keras.metrics import Precision, Recall
+from tensorflow.keras.layers import Dense, Dropout, Rescaling
 import google.generativeai as genai
 import PIL.Image
-import os
+import io
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 load_dotenv()
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+# Single-image inference doesn't benefit from thread pools spanning every core
+tf.config.threading.set_intra_op_parallelism_threads(min(4, os.cpu_count() or 1))
+tf.config.threading.set_inter_op_parallelism_threads(1)
 
-output_dir = 'saliency_maps'
-os.makedirs(output_dir, exist_ok=True)
+genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
 # Function to generate the initial explanation based on prediction
-def generate_explanation(img_path, model_prediction, confidence):
+def generate_explanation(pil_img, model_prediction, confidence):
     prompt = f"""
     You are an expert neurologist interpreting a saliency map for a brain MRI scan, generated by a deep learning model trained to classify brain tumors into categories: glioma, meningioma, pituitary, or no tumor.
 
@@ -40,11 +46,19 @@ def generate_explanation(img_path, model_prediction, confidence):
 
     Based on the above context, answer the following question from the user in a detailed yet concise manner.
     """
-    img = PIL.Image.open(img_path)
-    model = genai.GenerativeModel(model_name="gemini-1.5-flash")
-    response = model.generate_content([prompt, img])
+    model = get_gemini_model()
+    response = model.generate_content([prompt, pil_img])
     return response.text
 
+# Upload the scan to Gemini once per file and reuse the handle across chat turns
+def get_gemini_file(tab_key, uploaded_file):
+    key = f"{tab_key}_gfile"
+    cached = st.session_state.get(key)
+    if cached is None or cached[0] != uploaded_file.file_id:
+        gemini_file = genai.upload_file(io.BytesIO(uploaded_file.getvalue()), mime_type=uploaded_file.type)
+        st.session_state[key] = (uploaded_file.file_id, gemini_file)
+    return st.session_state[key][1]
+
 # Function to generate chat responses based on user questions
 def generate_neurology_chat_response(model, img, user_query, model_prediction, confidence):
     prompt = f"""
@@ -65,62 +79,73 @@ def generate_neurology_chat_response(model, img, user_query, model_prediction, c
     response = model.generate_content([prompt, img])
     return response.text
 
-def generate_saliency_map(model, img, img_array, class_index, img_size, uploaded_file):
-    with tf.GradientTape() as tape:
-        img_tensor = tf.convert_to_tensor(img_array)
-        tape.watch(img_tensor)
-        predictions = model(img_tensor)
-        target_class = predictions[:, class_index]
-
-    gradients = tape.gradient(target_class, img_tensor)
-    gradients = tf.math.abs(gradients)
-    gradients = tf.reduce_max(gradients, axis=-1)
-    gradients = gradients.numpy().squeeze()
-
-    # Resize gradients to match original image size
-    gradients = cv2.resize(gradients, img_size)
-
-    # Create a circular mask for the brain area
-    center = (gradients.shape[0] // 2, gradients.shape[1] // 2)
-    radius = min(center[0], center[1]) - 10
-    y, x = np.ogrid[:gradients.shape[0], :gradients.shape[1]]
-    mask = (x - center[0])**2 + (y - center[1])**2 <= radius**2
-
-    # Apply mask to gradients
-    gradients = gradients * mask
-
-    # Normalize only the brain area
-    brain_gradients = gradients[mask]
-    if brain_gradients.max() > brain_gradients.min():
-        brain_gradients = (brain_gradients - brain_gradients.min()) / (brain_gradients.max() - brain_gradients.min())
-    gradients[mask] = brain_gradients
-
-    # Apply a higher threshold
-    threshold = np.percentile(gradients[mask], 80)
-    gradients[gradients < threshold] = 0
+# JET colormap as an RGB lookup table, indexed directly by uint8 gradients
+JET_RGB_LUT = cv2.cvtColor(
+    cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(1, 256, 1), cv2.COLORMAP_JET),
+    cv2.COLOR_BGR2RGB
+).reshape(256, 3)
+
+# Circular brain-area mask, built once per image size and kept across reruns
+@st.cache_resource(show_spinner=False)
+def get_brain_mask(h, w):
+    cy, cx = h // 2, w // 2
+    radius = min(cy, cx) - 10
+    y, x = np.ogrid[:h, :w]
+    mask = ((x - cx)**2 + (y - cy)**2 <= radius**2).astype(np.uint8)
+    mask.setflags(write=False)
+    return mask
+
+# XLA-compiled forward + input-gradient pass, held in st.cache_resource so the
+# trace is shared across reruns (module-level caches are rebuilt on every rerun)
+@st.cache_resource(show_spinner=False)
+def get_saliency_fn(model_path, _model):
+    model = _model
+    input_shape = (1,) + tuple(model.input_shape[1:])
+
+    @tf.function(input_signature=[tf.TensorSpec(input_shape, tf.float32)], jit_compile=True)
+    def saliency(img_tensor):
+        with tf.GradientTape() as tape:
+            tape.watch(img_tensor)
+            predictions = model(img_tensor, training=False)
+            class_index = tf.argmax(predictions[0])
+            target_class = predictions[:, class_index]
+
+        gradients = tape.gradient(target_class, img_tensor)
+        return predictions, tf.reduce_max(tf.math.abs(gradients), axis=-1)
+
+    return saliency
+
+# Single forward pass returning class probabilities and the top-class gradients
+def predict_with_saliency(saliency_fn, img_tensor):
+    predictions, gradients = saliency_fn(img_tensor)
+    return predictions.numpy(), gradients.numpy().squeeze()
+
+def generate_saliency_map(gradients, original_img, img_size):
+    # Input gradients are already at the model's input resolution; only resize if that differs
+    if gradients.shape[::-1] != tuple(img_size):
+        gradients = cv2.resize(gradients, img_size)
+
+    # Circular mask for the brain area
+    mask = get_brain_mask(*gradients.shape)
+
+    # Normalize only the brain area straight to uint8, leaving the rest at 0
+    gradients_u8 = np.zeros(gradients.shape, dtype=np.uint8)
+    cv2.normalize(gradients, gradients_u8, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U, mask=mask)
+
+    # Apply a higher threshold (80th percentile of the brain area, from its histogram)
+    hist = cv2.calcHist([gradients_u8], [0], mask, [256], [0, 256]).ravel()
+    cdf = np.cumsum(hist)
+    threshold = int(np.searchsorted(cdf, 0.8 * cdf[-1]))
+    cv2.threshold(gradients_u8, threshold - 1, 0, cv2.THRESH_TOZERO, dst=gradients_u8)
 
     # Apply more aggressive smoothing
-    gradients = cv2.GaussianBlur(gradients, (11, 11), 0)
+    cv2.GaussianBlur(gradients_u8, (11, 11), 0, dst=gradients_u8)
 
     # Create a heatmap overlay with enhanced contrast
-    heatmap = cv2.applyColorMap(np.uint8(255 * gradients), cv2.COLORMAP_JET)
-    heatmap = cv2.cvtColor(heatmap, cv2.COLOR_BGR2RGB)
-
-    # Resize heatmap to match original image size
-    heatmap = cv2.resize(heatmap, img_size)
-    # Superimpose the heatmap on original image with increased opacity
-    original_img = image.img_to_array(img)
-    superimposed_img = heatmap * 0.7 + original_img * 0.3
-    superimposed_img = superimposed_img.astype(np.uint8)
+    heatmap = JET_RGB_LUT[gradients_u8]
 
-    img_path = os.path.join(output_dir, uploaded_file.name)
-    with open(img_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-
-    saliency_map_path = f'saliency_maps/{uploaded_file.name}'
-
-    # Save the saliency map
-    cv2.imwrite(saliency_map_path, cv2.cvtColor(superimposed_img, cv2.COLOR_RGB2BGR))
+    # Superimpose the heatmap on the decoded uint8 image with increased opacity
+    superimposed_img = cv2.addWeighted(heatmap, 0.7, original_img, 0.3, 0)
 
     return superimposed_img
 
@@ -132,7 +157,6 @@ def load_xception_model(model_path):
 
     model = Sequential([
         base_model,
-        Flatten(),
         Dropout(rate=0.3),
         Dense(128, activation='relu'),
         Dropout(rate=0.25),
@@ -141,86 +165,186 @@ def load_xception_model(model_path):
 
     model.build((None,) + img_shape)
 
-    # Compile the model
-    model.compile(Adamax(learning_rate=0.001),
-                  loss='categorical_crossentropy',
-                  metrics=['accuracy',
-                           Precision(),
-                           Recall()])
-
     model.load_weights(model_path)
 
-    return model
+    return add_rescaling(model)
+
+def load_cnn_model(model_path):
+    return add_rescaling(load_model(model_path, compile=False))
+
+# Prepend the /255 input scaling so the models take raw pixel values
+def add_rescaling(model):
+    return Sequential([
+        tf.keras.Input(shape=model.input_shape[1:]),
+        Rescaling(1. / 255),
+        model
+    ])
+
+# Cached model handles so reruns and tabs reuse the same objects; no spinners,
+# since these can be reached from worker threads without a script context
+@st.cache_resource(show_spinner=False)
+def get_xception_model(model_path):
+    return load_xception_model(model_path)
+
+@st.cache_resource(show_spinner=False)
+def get_cnn_model(model_path):
+    return load_cnn_model(model_path)
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_model():
+    return genai.GenerativeModel(model_name="gemini-1.5-flash")
+
+# Compiled prediction function and input size for the selected model
+def get_classifier(selected_model):
+    if selected_model == "Transfer Learning - Xception":
+        model_path = 'xception_model.weights.h5'
+        model = get_xception_model(model_path)
+        img_size = (299, 299)
+    else:
+        model_path = 'cnn_model.h5'
+        model = get_cnn_model(model_path)
+        img_size = (224, 224)
+    return get_saliency_fn(model_path, model), img_size
+
+# Trace and XLA-compile a model's prediction function once, ahead of the first upload
+@st.cache_resource(show_spinner=False)
+def warm_up_classifier(selected_model):
+    saliency_fn, img_size = get_classifier(selected_model)
+    saliency_fn(tf.zeros((1,) + img_size[::-1] + (3,)))
+
+# Prediction and saliency map, memoized on the uploaded bytes and model choice
+@st.cache_data(show_spinner=False, max_entries=64)
+def classify_image(file_bytes, selected_model):
+    saliency_fn, img_size = get_classifier(selected_model)
+
+    img = cv2.cvtColor(cv2.imdecode(np.frombuffer(file_bytes, dtype=np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    img = cv2.resize(img, img_size, interpolation=cv2.INTER_AREA)
+    img_tensor = tf.constant(img[np.newaxis], dtype=tf.float32)
+
+    prediction, gradients = predict_with_saliency(saliency_fn, img_tensor)
+    saliency_map = generate_saliency_map(gradients, img, img_size)
+    return prediction, saliency_map
+
+# Gemini responses, memoized so reruns don't repeat identical requests
+@st.cache_data(show_spinner=False, max_entries=64)
+def cached_explanation(saliency_map, model_prediction, confidence):
+    return generate_explanation(PIL.Image.fromarray(saliency_map), model_prediction, confidence)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def cached_chat_response(file_bytes, user_query, model_prediction, confidence, _img):
+    return generate_neurology_chat_response(get_gemini_model(), _img, user_query, model_prediction, confidence)
 
 # Main Streamlit app with tabbed layout
 st.title("Brain Tumor Classification")
 
+labels = ['Glioma', 'Meningioma', 'No tumor', 'Pituitary']
+model_names = ("Transfer Learning - Xception", "Custom CNN")
+
+# Compile the default model at app start so the first prediction doesn't pay for it
+with st.spinner("Loading model..."):
+    warm_up_classifier(model_names[0])
+
+# Single upload shared by every tab
+st.write("Upload an image of a brain MRI to classify the tumor type.")
+uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"], key="mri_upload")
+
 # Tabs for different features
 tabs = st.tabs(["Single Prediction", "Model Comparison"])
 
-# Common functionality for each tab
-def display_tab_content(tab_key):
-    st.write("Upload an image of a brain MRI to classify the tumor type.")
-    uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"], key=tab_key)
-
-    if uploaded_file is not None:
-        selected_model = st.radio("Select Model", ("Transfer Learning - Xception", "Custom CNN"), key=f"{tab_key}_model")
-
-        if selected_model == "Transfer Learning - Xception":
-            model = load_xception_model('xception_model.weights.h5')
-            img_size = (299, 299)
-        else:
-            model = load_model('cnn_model.h5')
-            img_size = (224, 224)
-
-        labels = ['Glioma', 'Meningioma', 'No tumor', 'Pituitary']
-        img = image.load_img(uploaded_file, target_size=img_size)
-        img_array = image.img_to_array(img)
-        img_array = np.expand_dims(img_array, axis=0) / 255.0
-
-        prediction = model.predict(img_array)
-        class_index = np.argmax(prediction[0])
-        result = labels[class_index]
-
-        st.write(f"Predicted Class: {result}")
-        st.write("Predictions")
-        for label, prob in zip(labels, prediction[0]):
-            st.write(f"{label}: {prob:.4f}")
-
-        # Saliency map
-        saliency_map = generate_saliency_map(model, img, img_array, class_index, img_size, uploaded_file)
-        col1, col2 = st.columns(2)
-        with col1:
-            st.image(uploaded_file, caption='Uploaded Image', use_column_width=True)
-        with col2:
-            st.image(saliency_map, caption='Saliency Map', use_column_width=True)
-
-        # Explanation
-        saliency_map_path = f'saliency_maps/{uploaded_file.name}'
-        explanation = generate_explanation(saliency_map_path, result, prediction[0][class_index])
+# Prediction, saliency map, explanation and chat for one selected model
+def display_single_prediction(uploaded_file, tab_key):
+    selected_model = st.radio("Select Model", model_names, key=f"{tab_key}_model")
+
+    with st.spinner("Classifying the scan..."):
+        prediction, saliency_map = classify_image(uploaded_file.getvalue(), selected_model)
+    class_index = np.argmax(prediction[0])
+    result = labels[class_index]
+
+    st.write(f"Predicted Class: {result}")
+    st.write("Predictions")
+    for label, prob in zip(labels, prediction[0]):
+        st.write(f"{label}: {prob:.4f}")
+
+    # Saliency map
+    col1, col2 = st.columns(2)
+    with col1:
+        st.image(uploaded_file, caption='Uploaded Image', use_column_width=True)
+    with col2:
+        st.image(saliency_map, caption='Saliency Map', use_column_width=True)
+
+    # Explanation, filled in once the Gemini call returns
+    explanation_container = st.container()
+
+    # Chat with the MRI feature
+    st.write("### Chat with the MRI Image")
+    st.write("Ask questions about the MRI scan to the multimodal LLM.")
+    user_query = st.text_input("Your question about the MRI scan:", key=f"{tab_key}_query")
+
+    explanation_args = (saliency_map, result, prediction[0][class_index])
+    chat_kwargs = None
+    if user_query:
+        chat_kwargs = dict(
+            file_bytes=uploaded_file.getvalue(),
+            user_query=user_query,
+            model_prediction=result,
+            confidence=prediction[0][class_index],
+            _img=get_gemini_file(tab_key, uploaded_file)
+        )
+
+    # The explanation is normally cached by the time a question is asked; both
+    # requests only miss together (e.g. after a model switch with a query filled
+    # in), and only then is it worth running them concurrently
+    explained = st.session_state.setdefault("explained", set())
+    explanation_key = (uploaded_file.file_id, selected_model)
+    chat_future = None
+    with explanation_container:
         st.write("### Explanation")
+        with st.spinner("Generating explanation..."):
+            if chat_kwargs is not None and explanation_key not in explained:
+                executor = ThreadPoolExecutor(max_workers=2)
+                explanation_future = executor.submit(cached_explanation, *explanation_args)
+                chat_future = executor.submit(cached_chat_response, **chat_kwargs)
+                executor.shutdown(wait=False)
+                explanation = explanation_future.result()
+            else:
+                explanation = cached_explanation(*explanation_args)
+        explained.add(explanation_key)
         st.write(explanation)
 
-        # Chat with the MRI feature
-        st.write("### Chat with the MRI Image")
-        st.write("Ask questions about the MRI scan to the multimodal LLM.")
-        user_query = st.text_input("Your question about the MRI scan:", key=f"{tab_key}_query")
-
-        if user_query:
-            response_text = generate_neurology_chat_response(
-                model=genai.GenerativeModel(model_name="gemini-1.5-flash"),
-                img=img,
-                user_query=user_query,
-                model_prediction=result,
-                confidence=prediction[0][class_index]
-            )
-            st.write("### Model's Response:")
-            st.write(response_text)
-
-# Single Prediction Tab
-with tabs[0]:
-    display_tab_content("single_prediction")
-
-# Model Comparison Tab
-with tabs[1]:
-    display_tab_content("model_comparison")
+    if chat_kwargs is not None:
+        with st.spinner("Answering your question..."):
+            response_text = chat_future.result() if chat_future is not None else cached_chat_response(**chat_kwargs)
+        st.write("### Model's Response:")
+        st.write(response_text)
+
+# Side-by-side predictions from both models on the same upload, only when requested
+def display_model_comparison(uploaded_file):
+    if not st.checkbox("Compare both models on this scan", key="compare_models"):
+        return
+
+    # Load both models on the script thread before fanning out
+    with st.spinner("Loading models..."):
+        for name in model_names:
+            get_classifier(name)
+
+    file_bytes = uploaded_file.getvalue()
+    with ThreadPoolExecutor(max_workers=len(model_names)) as executor:
+        futures = [executor.submit(classify_image, file_bytes, name) for name in model_names]
+
+    for col, name, future in zip(st.columns(len(model_names)), model_names, futures):
+        prediction, saliency_map = future.result()
+        with col:
+            st.write(f"### {name}")
+            st.write(f"Predicted Class: {labels[np.argmax(prediction[0])]}")
+            for label, prob in zip(labels, prediction[0]):
+                st.write(f"{label}: {prob:.4f}")
+            st.image(saliency_map, caption='Saliency Map', use_column_width=True)
+
+if uploaded_file is not None:
+    # Single Prediction Tab
+    with tabs[0]:
+        display_single_prediction(uploaded_file, "single_prediction")
+
+    # Model Comparison Tab
+    with tabs[1]:
+        display_model_comparison(uploaded_file)